@@ -1,5 +1,7 @@
+import errno
 import logging
 import os
+import shutil
 from collections import defaultdict
 
 import pathvalidate
@@ -52,6 +54,62 @@ def delete_empty_directories(directory, root):
         directory = os.path.normpath(os.path.dirname(directory))
 
 
+def copy_file(source, target):
+    """
+    Copies source to target, including its metadata, like shutil.copy2.
+    Where possible, the data is copied with os.copy_file_range, which
+    stays in the kernel and lets copy-on-write file systems share the
+    data blocks instead of duplicating them.
+    """
+    if hasattr(os, "copy_file_range"):  # Linux only
+        try:
+            with open(source, "rb") as src, open(target, "wb") as dst:
+                size = os.fstat(src.fileno()).st_size
+                copied = 0
+                while copied < size:
+                    n = os.copy_file_range(src.fileno(), dst.fileno(), 1024**3)
+                    if not n:
+                        break
+                    copied += n
+        except OSError as e:
+            # Not supported for these files, e.g. across file systems
+            if e.errno not in {
+                errno.EXDEV,
+                errno.ENOSYS,
+                errno.EOPNOTSUPP,
+                errno.EINVAL,
+            }:
+                raise
+        else:
+            # Some file systems report end of file without copying anything,
+            # fall back to a regular copy if the data is incomplete
+            if copied == size:
+                shutil.copystat(source, target)
+                return
+
+    shutil.copy2(source, target)
+
+
+def iter_files(directory):
+    """
+    Yields the paths of all files below directory, like os.walk would list
+    them, but without an additional stat call for each entry.
+    """
+    try:
+        entries = os.scandir(directory)
+    except OSError:
+        # Same as os.walk, skip directories that can't be read
+        return
+    with entries:
+        for entry in entries:
+            if entry.is_dir():
+                # Same as os.walk, don't descend into symlinked directories
+                if not entry.is_symlink():
+                    yield from iter_files(entry.path)
+            else:
+                yield entry.path
+
+
 def many_to_dictionary(field):
     # Converts ManyToManyField to dictionary by assuming, that field
     # entries contain an _ or - which will be used as a delimiter
@@ -1,9 +1,10 @@
 import hashlib
-import json
 import os
 import shutil
 import tempfile
-import time
+from collections import namedtuple
+from concurrent.futures import as_completed
+from concurrent.futures import ThreadPoolExecutor
 
 import tqdm
 from django.conf import settings
@@ -32,8 +33,53 @@ from paperless.db import GnuPG
 from paperless_mail.models import MailAccount
 from paperless_mail.models import MailRule
 
+from ...file_handling import copy_file
 from ...file_handling import delete_empty_directories
 from ...file_handling import generate_filename
+from ...file_handling import iter_files
+from ..manifest import dump_json
+from ..manifest import load_json
+
+# Checksums of files in the export directory, computed by previous runs with
+# --compare-checksums
+CHECKSUM_CACHE_NAME = ".checksums.json"
+
+# Number of documents whose files are exported at the same time, each
+# encrypted document runs its own gpg process
+EXPORT_WORKERS = 4
+
+
+# What a worker thread needs to export the files of one document, so that the
+# document instances, including their content, can be released early
+DocumentFiles = namedtuple(
+    "DocumentFiles",
+    [
+        "storage_type",
+        "created_ns",
+        "source_path",
+        "checksum",
+        "original_target",
+        "thumbnail_path",
+        "thumbnail_target",
+        "archive_path",
+        "archive_checksum",
+        "archive_target",
+    ],
+)
+
+
+def file_checksum(path) -> str:
+    """
+    Returns the MD5 checksum of the file at path, without reading the whole
+    file into memory.
+    """
+    with open(path, "rb") as f:
+        if hasattr(hashlib, "file_digest"):  # Python 3.11+
+            return hashlib.file_digest(f, "md5").hexdigest()
+        checksum = hashlib.md5()
+        while chunk := f.read(1024 * 1024):
+            checksum.update(chunk)
+        return checksum.hexdigest()
 
 
 class Command(BaseCommand):
@@ -64,8 +110,8 @@ class Command(BaseCommand):
             default=False,
             action="store_true",
             help="Compare file checksums when determining whether to export "
-            "a file or not. If not specified, file size and time "
-            "modified is used instead.",
+            "a file whose size or time modified differs. If not specified, "
+            "such files are always exported.",
         )
 
         parser.add_argument(
@@ -131,14 +177,18 @@ class Command(BaseCommand):
         BaseCommand.__init__(self, *args, **kwargs)
         self.target = None
         self.split_manifest = None
-        self.files_in_export_dir = []
-        self.exported_files = []
+        self.files_in_export_dir = set()
+        self.exported_files = set()
+        self.filename_counters = {}
         self.compare_checksums = False
         self.use_filename_format = False
         self.use_filename_prefix = False
         self.delete = False
         self.no_archive = False
         self.no_thumbnail = False
+        self.use_checksum_cache = False
+        self.checksum_cache = {}
+        self.checked_checksums = {}
 
     def handle(self, *args, **options):
 
@@ -151,6 +201,8 @@ class Command(BaseCommand):
         self.no_archive = options["no_archive"]
         self.no_thumbnail = options["no_thumbnail"]
         zip_export: bool = options["zip"]
+        # A cache in the temporary directory of a zip export is never reused
+        self.use_checksum_cache = self.compare_checksums and not zip_export
 
         # If zipping, save the original target for later and
         # get a temporary directory for the target
@@ -170,6 +222,10 @@ class Command(BaseCommand):
         if not os.access(self.target, os.W_OK):
             raise CommandError("That path doesn't appear to be writable")
 
+        # Resolve the target once, so that all paths built from it are
+        # absolute and can be compared with the export directory snapshot
+        self.target = os.path.abspath(self.target)
+
         try:
             with FileLock(settings.MEDIA_LOCK):
                 self.dump(options["no_progress_bar"])
@@ -193,182 +249,188 @@ class Command(BaseCommand):
 
     def dump(self, progress_bar_disable=False):
         # 1. Take a snapshot of what files exist in the current export folder
-        for root, dirs, files in os.walk(self.target):
-            self.files_in_export_dir.extend(
-                map(lambda f: os.path.abspath(os.path.join(root, f)), files),
-            )
+        self.files_in_export_dir.update(iter_files(self.target))
+
+        if self.use_checksum_cache:
+            self.load_checksum_cache()
 
         # 2. Create manifest, containing all correspondents, types, tags, storage paths
         # comments, documents and ui_settings
         with transaction.atomic():
-            manifest = json.loads(
-                serializers.serialize("json", Correspondent.objects.all()),
-            )
+            manifest = serializers.serialize("python", Correspondent.objects.all())
 
-            manifest += json.loads(serializers.serialize("json", Tag.objects.all()))
+            manifest += serializers.serialize("python", Tag.objects.all())
 
-            manifest += json.loads(
-                serializers.serialize("json", DocumentType.objects.all()),
-            )
+            manifest += serializers.serialize("python", DocumentType.objects.all())
 
-            manifest += json.loads(
-                serializers.serialize("json", StoragePath.objects.all()),
-            )
+            manifest += serializers.serialize("python", StoragePath.objects.all())
 
-            manifest += json.loads(
-                serializers.serialize("json", Comment.objects.all()),
-            )
+            manifest += serializers.serialize("python", Comment.objects.all())
 
-            documents = Document.objects.order_by("id")
-            document_map = {d.pk: d for d in documents}
-            document_manifest = json.loads(serializers.serialize("json", documents))
-            if not self.split_manifest:
-                manifest += document_manifest
-
-            manifest += json.loads(
-                serializers.serialize("json", MailAccount.objects.all()),
-            )
-
-            manifest += json.loads(
-                serializers.serialize("json", MailRule.objects.all()),
-            )
-
-            manifest += json.loads(
-                serializers.serialize("json", SavedView.objects.all()),
+            # 3. Export files from each document. Documents are fetched and
+            # serialized in chunks, instead of loading all of them at once.
+            document_manifest = []
+            document_exports = []
+            documents = (
+                Document.objects.order_by("id")
+                .select_related("correspondent", "document_type", "storage_path")
+                .prefetch_related("tags")
             )
+            for document in documents.iterator(chunk_size=2000):
+                document_dict = serializers.serialize("python", [document])[0]
+                if not self.split_manifest:
+                    document_manifest.append(document_dict)
+
+                # 3.1. store files unencrypted
+                document_dict["fields"][
+                    "storage_type"
+                ] = Document.STORAGE_TYPE_UNENCRYPTED
+
+                # 3.2. generate a unique filename
+                base_name = self.generate_base_name(document)
+                if base_name in self.exported_files:
+                    # Continue from the last counter used for this name rather
+                    # than trying all of them again
+                    filename_counter = self.filename_counters.get(base_name, 0)
+                    unique_name = base_name
+                    while unique_name in self.exported_files:
+                        filename_counter += 1
+                        unique_name = self.generate_base_name(
+                            document,
+                            filename_counter,
+                        )
+                    self.filename_counters[base_name] = filename_counter
+                    base_name = unique_name
+                self.exported_files.add(base_name)
+
+                # 3.3. write filenames into manifest
+                original_name = base_name
+                if self.use_filename_prefix:
+                    original_name = os.path.join("originals", original_name)
+                original_target = os.path.normpath(
+                    os.path.join(self.target, original_name),
+                )
+                document_dict[EXPORTER_FILE_NAME] = original_name
+
+                if not self.no_thumbnail:
+                    thumbnail_name = base_name + "-thumbnail.webp"
+                    if self.use_filename_prefix:
+                        thumbnail_name = os.path.join("thumbnails", thumbnail_name)
+                    thumbnail_target = os.path.normpath(
+                        os.path.join(self.target, thumbnail_name),
+                    )
+                    document_dict[EXPORTER_THUMBNAIL_NAME] = thumbnail_name
+                else:
+                    thumbnail_target = None
+
+                if not self.no_archive and document.has_archive_version:
+                    archive_name = base_name + "-archive.pdf"
+                    if self.use_filename_prefix:
+                        archive_name = os.path.join("archive", archive_name)
+                    archive_target = os.path.normpath(
+                        os.path.join(self.target, archive_name),
+                    )
+                    document_dict[EXPORTER_ARCHIVE_NAME] = archive_name
+                else:
+                    archive_target = None
+
+                # Keep the sub-second precision of the created date
+                created_ns = round(document.created.timestamp() * 1_000_000) * 1000
+                document_exports.append(
+                    DocumentFiles(
+                        storage_type=document.storage_type,
+                        created_ns=created_ns,
+                        source_path=document.source_path,
+                        checksum=document.checksum,
+                        original_target=original_target,
+                        thumbnail_path=document.thumbnail_path,
+                        thumbnail_target=thumbnail_target,
+                        archive_path=document.archive_path if archive_target else None,
+                        archive_checksum=document.archive_checksum,
+                        archive_target=archive_target,
+                    ),
+                )
 
-            manifest += json.loads(
-                serializers.serialize("json", SavedViewFilterRule.objects.all()),
-            )
+                if self.split_manifest:
+                    manifest_name = base_name + "-manifest.json"
+                    if self.use_filename_prefix:
+                        manifest_name = os.path.join("json", manifest_name)
+                    manifest_name = os.path.normpath(
+                        os.path.join(self.target, manifest_name),
+                    )
+                    self.files_in_export_dir.discard(manifest_name)
+                    os.makedirs(os.path.dirname(manifest_name), exist_ok=True)
+                    with open(manifest_name, "wb") as f:
+                        f.write(dump_json([document_dict]))
 
-            manifest += json.loads(serializers.serialize("json", Group.objects.all()))
+            # Empty with --split-manifest, the documents are written already
+            manifest += document_manifest
 
-            manifest += json.loads(serializers.serialize("json", User.objects.all()))
+            manifest += serializers.serialize("python", MailAccount.objects.all())
 
-            manifest += json.loads(
-                serializers.serialize("json", UiSettings.objects.all()),
+            manifest += serializers.serialize(
+                "python",
+                MailRule.objects.prefetch_related("assign_tags"),
             )
 
-        # 3. Export files from each document
-        for index, document_dict in tqdm.tqdm(
-            enumerate(document_manifest),
-            total=len(document_manifest),
-            disable=progress_bar_disable,
-        ):
-            # 3.1. store files unencrypted
-            document_dict["fields"]["storage_type"] = Document.STORAGE_TYPE_UNENCRYPTED
-
-            document = document_map[document_dict["pk"]]
-
-            # 3.2. generate a unique filename
-            filename_counter = 0
-            while True:
-                if self.use_filename_format:
-                    base_name = generate_filename(
-                        document,
-                        counter=filename_counter,
-                        append_gpg=False,
-                    )
-                else:
-                    base_name = document.get_public_filename(counter=filename_counter)
-
-                if base_name not in self.exported_files:
-                    self.exported_files.append(base_name)
-                    break
-                else:
-                    filename_counter += 1
-
-            # 3.3. write filenames into manifest
-            original_name = base_name
-            if self.use_filename_prefix:
-                original_name = os.path.join("originals", original_name)
-            original_target = os.path.join(self.target, original_name)
-            document_dict[EXPORTER_FILE_NAME] = original_name
+            manifest += serializers.serialize("python", SavedView.objects.all())
 
-            if not self.no_thumbnail:
-                thumbnail_name = base_name + "-thumbnail.webp"
-                if self.use_filename_prefix:
-                    thumbnail_name = os.path.join("thumbnails", thumbnail_name)
-                thumbnail_target = os.path.join(self.target, thumbnail_name)
-                document_dict[EXPORTER_THUMBNAIL_NAME] = thumbnail_name
-            else:
-                thumbnail_target = None
-
-            if not self.no_archive and document.has_archive_version:
-                archive_name = base_name + "-archive.pdf"
-                if self.use_filename_prefix:
-                    archive_name = os.path.join("archive", archive_name)
-                archive_target = os.path.join(self.target, archive_name)
-                document_dict[EXPORTER_ARCHIVE_NAME] = archive_name
-            else:
-                archive_target = None
-
-            # 3.4. write files to target folder
-            t = int(time.mktime(document.created.timetuple()))
-            if document.storage_type == Document.STORAGE_TYPE_GPG:
-
-                os.makedirs(os.path.dirname(original_target), exist_ok=True)
-                with open(original_target, "wb") as f:
-                    with document.source_file as out_file:
-                        f.write(GnuPG.decrypted(out_file))
-                        os.utime(original_target, times=(t, t))
-
-                if thumbnail_target:
-                    os.makedirs(os.path.dirname(thumbnail_target), exist_ok=True)
-                    with open(thumbnail_target, "wb") as f:
-                        with document.thumbnail_file as out_file:
-                            f.write(GnuPG.decrypted(out_file))
-                            os.utime(thumbnail_target, times=(t, t))
-
-                if archive_target:
-                    os.makedirs(os.path.dirname(archive_target), exist_ok=True)
-                    with open(archive_target, "wb") as f:
-                        with document.archive_path as out_file:
-                            f.write(GnuPG.decrypted(out_file))
-                            os.utime(archive_target, times=(t, t))
-            else:
-                self.check_and_copy(
-                    document.source_path,
-                    document.checksum,
-                    original_target,
-                )
+            manifest += serializers.serialize(
+                "python",
+                SavedViewFilterRule.objects.all(),
+            )
 
-                if thumbnail_target:
-                    self.check_and_copy(document.thumbnail_path, None, thumbnail_target)
+            manifest += serializers.serialize(
+                "python",
+                Group.objects.prefetch_related("permissions"),
+            )
 
-                if archive_target:
-                    self.check_and_copy(
-                        document.archive_path,
-                        document.archive_checksum,
-                        archive_target,
-                    )
+            manifest += serializers.serialize(
+                "python",
+                User.objects.prefetch_related("groups", "user_permissions"),
+            )
 
-            if self.split_manifest:
-                manifest_name = base_name + "-manifest.json"
-                if self.use_filename_prefix:
-                    manifest_name = os.path.join("json", manifest_name)
-                manifest_name = os.path.join(self.target, manifest_name)
-                if manifest_name in self.files_in_export_dir:
-                    self.files_in_export_dir.remove(manifest_name)
-                os.makedirs(os.path.dirname(manifest_name), exist_ok=True)
-                with open(manifest_name, "w") as f:
-                    json.dump([document_manifest[index]], f, indent=2)
+            manifest += serializers.serialize("python", UiSettings.objects.all())
+
+        # 3.4. write files to target folder. This is bound by disk I/O, so
+        # handle several documents at once. The workers update
+        # files_in_export_dir and checked_checksums without a lock, which is
+        # safe because single set and dict operations are atomic.
+        with ThreadPoolExecutor(max_workers=EXPORT_WORKERS) as executor:
+            futures = [
+                executor.submit(self.export_document_files, files)
+                for files in document_exports
+            ]
+            try:
+                for future in tqdm.tqdm(
+                    as_completed(futures),
+                    total=len(futures),
+                    disable=progress_bar_disable,
+                ):
+                    future.result()
+            except Exception:
+                # Don't keep copying files after a document failed
+                for future in futures:
+                    future.cancel()
+                raise
 
         # 4.1 write manifest to target folder
-        manifest_path = os.path.abspath(os.path.join(self.target, "manifest.json"))
-        if manifest_path in self.files_in_export_dir:
-            self.files_in_export_dir.remove(manifest_path)
+        manifest_path = os.path.join(self.target, "manifest.json")
+        self.files_in_export_dir.discard(manifest_path)
 
-        with open(manifest_path, "w") as f:
-            json.dump(manifest, f, indent=2)
+        with open(manifest_path, "wb") as f:
+            f.write(dump_json(manifest))
 
         # 4.2 write version information to target folder
-        version_path = os.path.abspath(os.path.join(self.target, "version.json"))
-        if version_path in self.files_in_export_dir:
-            self.files_in_export_dir.remove(version_path)
+        version_path = os.path.join(self.target, "version.json")
+        self.files_in_export_dir.discard(version_path)
 
-        with open(version_path, "w") as f:
-            json.dump({"version": version.__full_version_str__}, f, indent=2)
+        with open(version_path, "wb") as f:
+            f.write(dump_json({"version": version.__full_version_str__}))
+
+        # 4.3 write checksums of the exported files for the next run
+        if self.use_checksum_cache:
+            self.save_checksum_cache()
 
         if self.delete:
             # 5. Remove files which we did not explicitly export in this run
@@ -376,32 +438,118 @@ class Command(BaseCommand):
             for f in self.files_in_export_dir:
                 os.remove(f)
 
-                delete_empty_directories(
-                    os.path.abspath(os.path.dirname(f)),
-                    os.path.abspath(self.target),
+                delete_empty_directories(os.path.dirname(f), self.target)
+
+    def generate_base_name(self, document, counter=0):
+        if self.use_filename_format:
+            return generate_filename(document, counter=counter, append_gpg=False)
+        else:
+            return document.get_public_filename(counter=counter)
+
+    def load_checksum_cache(self):
+        cache_path = os.path.join(self.target, CHECKSUM_CACHE_NAME)
+        if not os.path.isfile(cache_path):
+            return
+        try:
+            with open(cache_path, "rb") as f:
+                cache = load_json(f.read())
+            checksum_cache = {
+                os.path.join(self.target, name): (size, mtime_ns, checksum)
+                for name, (size, mtime_ns, checksum) in cache.items()
+            }
+        except (ValueError, TypeError, AttributeError):
+            # A damaged cache only means checksums get computed again
+            return
+        self.checksum_cache = checksum_cache
+
+    def save_checksum_cache(self):
+        cache_path = os.path.join(self.target, CHECKSUM_CACHE_NAME)
+        self.files_in_export_dir.discard(cache_path)
+
+        # Only keep the files checked in this run, so that entries of removed
+        # files don't pile up
+        cache = {
+            os.path.relpath(path, self.target): entry
+            for path, entry in self.checked_checksums.items()
+        }
+        with open(cache_path, "wb") as f:
+            f.write(dump_json(cache))
+
+    def get_target_checksum(self, target, target_stat):
+        """
+        Returns the checksum of an existing file in the export directory,
+        reusing the checksum from a previous run if the file is unchanged.
+        """
+        size, mtime_ns = target_stat.st_size, target_stat.st_mtime_ns
+        cached = self.checksum_cache.get(target)
+        if cached is not None and cached[:2] == (size, mtime_ns):
+            checksum = cached[2]
+        else:
+            checksum = file_checksum(target)
+        self.checked_checksums[target] = (size, mtime_ns, checksum)
+        return checksum
+
+    def export_document_files(self, files: DocumentFiles):
+        """
+        Writes the files of a single document to the export directory. This
+        runs in a worker thread, so it must not access the database.
+        """
+        if files.storage_type == Document.STORAGE_TYPE_GPG:
+            for source, target in (
+                (files.source_path, files.original_target),
+                (files.thumbnail_path, files.thumbnail_target),
+                (files.archive_path, files.archive_target),
+            ):
+                if not target:
+                    continue
+                self.files_in_export_dir.discard(target)
+                os.makedirs(os.path.dirname(target), exist_ok=True)
+                # Let gpg write the file, the plaintext is never held in memory
+                with open(source, "rb") as f:
+                    GnuPG.decrypt_to_file(f, target)
+                os.utime(target, ns=(files.created_ns, files.created_ns))
+        else:
+            self.check_and_copy(
+                files.source_path,
+                files.checksum,
+                files.original_target,
+            )
+
+            if files.thumbnail_target:
+                self.check_and_copy(files.thumbnail_path, None, files.thumbnail_target)
+
+            if files.archive_target:
+                self.check_and_copy(
+                    files.archive_path,
+                    files.archive_checksum,
+                    files.archive_target,
                 )
 
     def check_and_copy(self, source, source_checksum, target):
-        if os.path.abspath(target) in self.files_in_export_dir:
-            self.files_in_export_dir.remove(os.path.abspath(target))
+        self.files_in_export_dir.discard(target)
 
         perform_copy = False
 
         if os.path.exists(target):
             source_stat = os.stat(source)
             target_stat = os.stat(target)
-            if self.compare_checksums and source_checksum:
-                with open(target, "rb") as f:
-                    target_checksum = hashlib.md5(f.read()).hexdigest()
+            stat_changed = (
+                source_stat.st_mtime != target_stat.st_mtime
+                or source_stat.st_size != target_stat.st_size
+            )
+            if stat_changed and self.compare_checksums and source_checksum:
+                # Only hash files which may have changed, the checksum
+                # decides whether they did
+                target_checksum = self.get_target_checksum(target, target_stat)
                 perform_copy = target_checksum != source_checksum
-            elif source_stat.st_mtime != target_stat.st_mtime:
-                perform_copy = True
-            elif source_stat.st_size != target_stat.st_size:
-                perform_copy = True
+            else:
+                perform_copy = stat_changed
         else:
             # Copy if it does not exist
             perform_copy = True
 
         if perform_copy:
+            # The checksum of the replaced file is of no use anymore
+            self.checked_checksums.pop(target, None)
             os.makedirs(os.path.dirname(target), exist_ok=True)
-            shutil.copy2(source, target)
+            copy_file(source, target)
@@ -1,7 +1,7 @@
-import json
 import logging
 import os
-import shutil
+from concurrent.futures import as_completed
+from concurrent.futures import ThreadPoolExecutor
 from contextlib import contextmanager
 from pathlib import Path
 
@@ -22,8 +22,14 @@ from documents.settings import EXPORTER_THUMBNAIL_NAME
 from filelock import FileLock
 from paperless import version
 
+from ...file_handling import copy_file
 from ...file_handling import create_source_path_directory
+from ...file_handling import iter_files
 from ...signals.handlers import update_filename_and_move_files
+from ..manifest import load_json
+
+# Number of documents whose files are copied at the same time
+IMPORT_WORKERS = 4
 
 
 @contextmanager
@@ -79,22 +85,20 @@ class Command(BaseCommand):
         )
         self._check_manifest_exists(main_manifest_path)
 
-        with open(main_manifest_path) as f:
-            self.manifest = json.load(f)
+        with open(main_manifest_path, "rb") as f:
+            self.manifest = load_json(f.read())
         manifest_paths.append(main_manifest_path)
 
-        for root, dirs, files in os.walk(self.source):
-            for file in files:
-                if file.endswith("-manifest.json"):
-                    doc_manifest_path = os.path.normpath(os.path.join(root, file))
-                    with open(doc_manifest_path) as f:
-                        self.manifest += json.load(f)
-                    manifest_paths.append(doc_manifest_path)
+        for doc_manifest_path in iter_files(os.path.normpath(self.source)):
+            if doc_manifest_path.endswith("-manifest.json"):
+                with open(doc_manifest_path, "rb") as f:
+                    self.manifest.extend(load_json(f.read()))
+                manifest_paths.append(doc_manifest_path)
 
         version_path = os.path.normpath(os.path.join(self.source, "version.json"))
         if os.path.exists(version_path):
-            with open(version_path) as f:
-                self.version = json.load(f)["version"]
+            with open(version_path, "rb") as f:
+                self.version = load_json(f.read())["version"]
                 # Provide an initial warning if needed to the user
                 if self.version != version.__full_version_str__:
                     self.stdout.write(
@@ -122,8 +126,9 @@ class Command(BaseCommand):
             ):
                 # Fill up the database with whatever is in the manifest
                 try:
-                    for manifest_path in manifest_paths:
-                        call_command("loaddata", manifest_path)
+                    # A single loaddata call loads all manifests in one
+                    # transaction
+                    call_command("loaddata", *manifest_paths)
                 except (FieldDoesNotExist, DeserializationError) as e:
                     self.stdout.write(self.style.ERROR("Database import failed"))
                     if (
@@ -200,9 +205,10 @@ class Command(BaseCommand):
             filter(lambda r: r["model"] == "documents.document", self.manifest),
         )
 
-        for record in tqdm.tqdm(manifest_documents, disable=progress_bar_disable):
+        document_imports = []
+        for record in manifest_documents:
 
-            document = Document.objects.get(pk=record["pk"])
+            document = Document.objects.defer("content").get(pk=record["pk"])
 
             doc_file = record[EXPORTER_FILE_NAME]
             document_path = os.path.join(self.source, doc_file)
@@ -221,34 +227,77 @@ class Command(BaseCommand):
 
             document.storage_type = Document.STORAGE_TYPE_UNENCRYPTED
 
-            with FileLock(settings.MEDIA_LOCK):
-                if os.path.isfile(document.source_path):
-                    raise FileExistsError(document.source_path)
-
-                create_source_path_directory(document.source_path)
-
-                shutil.copy2(document_path, document.source_path)
-
-                if thumbnail_path:
-                    if thumbnail_path.suffix in {".png", ".PNG"}:
-                        run_convert(
-                            density=300,
-                            scale="500x5000>",
-                            alpha="remove",
-                            strip=True,
-                            trim=False,
-                            auto_orient=True,
-                            input_file=f"{thumbnail_path}[0]",
-                            output_file=str(document.thumbnail_path),
-                        )
-                    else:
-                        shutil.copy2(thumbnail_path, document.thumbnail_path)
+            document_imports.append(
+                (document, document_path, thumbnail_path, archive_path),
+            )
 
-                if archive_path:
-                    create_source_path_directory(document.archive_path)
-                    # TODO: this assumes that the export is valid and
-                    #  archive_filename is present on all documents with
-                    #  archived files
-                    shutil.copy2(archive_path, document.archive_path)
+        # Acquire the media lock once for the whole import rather than once
+        # per document. Copying is bound by disk I/O, so handle several
+        # documents at once.
+        with FileLock(settings.MEDIA_LOCK):
+            # Few workers, converting legacy PNG thumbnails uses a lot of memory
+            with ThreadPoolExecutor(max_workers=IMPORT_WORKERS) as executor:
+                futures = [
+                    executor.submit(self._import_document_files, *args)
+                    for args in document_imports
+                ]
+                try:
+                    for future in tqdm.tqdm(
+                        as_completed(futures),
+                        total=len(futures),
+                        disable=progress_bar_disable,
+                    ):
+                        future.result()
+                except Exception:
+                    # Don't keep copying files after a document failed
+                    for future in futures:
+                        future.cancel()
+                    raise
+
+            # Only the storage type was changed, update it for all documents
+            # at once
+            Document.objects.bulk_update(
+                [document for document, *_ in document_imports],
+                ["storage_type"],
+                batch_size=500,
+            )
 
-            document.save()
+    @staticmethod
+    def _import_document_files(
+        document,
+        document_path,
+        thumbnail_path,
+        archive_path,
+    ):
+        """
+        Copies the files of a single document into paperless. This runs in a
+        worker thread, so it must not access the database.
+        """
+        if os.path.isfile(document.source_path):
+            raise FileExistsError(document.source_path)
+
+        create_source_path_directory(document.source_path)
+
+        copy_file(document_path, document.source_path)
+
+        if thumbnail_path:
+            if thumbnail_path.suffix in {".png", ".PNG"}:
+                run_convert(
+                    density=300,
+                    scale="500x5000>",
+                    alpha="remove",
+                    strip=True,
+                    trim=False,
+                    auto_orient=True,
+                    input_file=f"{thumbnail_path}[0]",
+                    output_file=str(document.thumbnail_path),
+                )
+            else:
+                copy_file(thumbnail_path, document.thumbnail_path)
+
+        if archive_path:
+            create_source_path_directory(document.archive_path)
+            # TODO: this assumes that the export is valid and
+            #  archive_filename is present on all documents with
+            #  archived files
+            copy_file(archive_path, document.archive_path)
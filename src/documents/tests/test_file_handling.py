@@ -1,4 +1,5 @@
 import datetime
+import errno
 import hashlib
 import os
 import random
@@ -13,10 +14,12 @@ from django.test import override_settings
 from django.test import TestCase
 from django.utils import timezone
 
+from ..file_handling import copy_file
 from ..file_handling import create_source_path_directory
 from ..file_handling import delete_empty_directories
 from ..file_handling import generate_filename
 from ..file_handling import generate_unique_filename
+from ..file_handling import iter_files
 from ..models import Correspondent
 from ..models import Document
 from ..models import DocumentType
@@ -479,6 +482,62 @@ class TestFileHandling(DirectoriesMixin, TestCase):
         self.assertEqual(os.path.isfile(os.path.join(tmp, "notempty", "file")), True)
         self.assertEqual(os.path.isdir(os.path.join(tmp, "notempty", "empty")), False)
 
+    def test_copy_file(self):
+        source = os.path.join(settings.ORIGINALS_DIR, "source.pdf")
+        target = os.path.join(settings.ORIGINALS_DIR, "target.pdf")
+        Path(source).write_bytes(b"content" * 1024)
+        os.utime(source, times=(1000, 1000))
+
+        copy_file(source, target)
+
+        self.assertEqual(Path(target).read_bytes(), b"content" * 1024)
+        self.assertEqual(os.stat(target).st_mtime, 1000)
+
+    def test_copy_file_fallback(self):
+        source = os.path.join(settings.ORIGINALS_DIR, "source.pdf")
+        target = os.path.join(settings.ORIGINALS_DIR, "target.pdf")
+        Path(source).write_bytes(b"content" * 1024)
+        os.utime(source, times=(1000, 1000))
+
+        for side_effect in [
+            # Reports end of file without copying anything
+            lambda *args: 0,
+            OSError(errno.EXDEV, "Invalid cross-device link"),
+        ]:
+            with mock.patch(
+                "documents.file_handling.os.copy_file_range",
+                side_effect=side_effect,
+                create=True,
+            ) as m:
+                copy_file(source, target)
+                m.assert_called()
+
+            self.assertEqual(Path(target).read_bytes(), b"content" * 1024)
+            self.assertEqual(os.stat(target).st_mtime, 1000)
+            os.unlink(target)
+
+    def test_iter_files(self):
+        tmp = os.path.join(settings.ORIGINALS_DIR, "test_iter_files")
+        os.makedirs(os.path.join(tmp, "sub", "empty"))
+        Path(os.path.join(tmp, "file")).touch()
+        Path(os.path.join(tmp, "sub", "file")).touch()
+
+        self.assertCountEqual(
+            iter_files(tmp),
+            [os.path.join(tmp, "file"), os.path.join(tmp, "sub", "file")],
+        )
+
+        # Directories that can't be read are skipped
+        scandir = os.scandir
+
+        def scandir_denied(path):
+            if path == os.path.join(tmp, "sub"):
+                raise PermissionError(errno.EACCES, "Permission denied", path)
+            return scandir(path)
+
+        with mock.patch("documents.file_handling.os.scandir", scandir_denied):
+            self.assertCountEqual(iter_files(tmp), [os.path.join(tmp, "file")])
+
     @override_settings(FILENAME_FORMAT="{created/[title]")
     def test_invalid_format(self):
         document = Document()
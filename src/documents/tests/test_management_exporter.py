@@ -1,5 +1,4 @@
-import hashlib
-import json
+import functools
 import os
 import shutil
 import tempfile
@@ -7,11 +6,13 @@ from pathlib import Path
 from unittest import mock
 from zipfile import ZipFile
 
+from django.conf import settings
 from django.core.management import call_command
 from django.test import override_settings
 from django.test import TestCase
 from django.utils import timezone
 from documents.management.commands import document_exporter
+from documents.management.manifest import load_json
 from documents.models import Comment
 from documents.models import Correspondent
 from documents.models import Document
@@ -20,19 +21,72 @@ from documents.models import StoragePath
 from documents.models import Tag
 from documents.models import User
 from documents.sanity_checker import check_sanity
+from documents.settings import EXPORTER_ARCHIVE_NAME
 from documents.settings import EXPORTER_FILE_NAME
+from documents.settings import EXPORTER_THUMBNAIL_NAME
 from documents.tests.utils import DirectoriesMixin
 from documents.tests.utils import paperless_environment
+from paperless.db import DecryptionError
+
+
+_MODEL_DOCUMENT = "documents.document"
+_MODEL_COMMENT = "documents.comment"
+
+# Set PAPERLESS_TEST_TMPDIR to write exports somewhere else than the default
+# temporary directory, e.g. to memory backed storage. Copies between the media
+# directory and the export then cross file systems and can't use
+# copy_file_range.
+EXPORT_TMPDIR = os.environ.get("PAPERLESS_TEST_TMPDIR") or None
+
+
+def _link_or_copy(src, dst):
+    # Hard links are not available on every file system
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copy2(src, dst)
+
+
+def _with_sample_docs(test):
+    """
+    Runs the test with a fresh copy of the sample documents in the media
+    directory
+    """
+
+    @functools.wraps(test)
+    def wrapper(self, *args, **kwargs):
+        self._materialize_samples()
+        return test(self, *args, **kwargs)
+
+    return wrapper
 
 
 class TestExportImport(DirectoriesMixin, TestCase):
-    def setUp(self) -> None:
-        self.target = tempfile.mkdtemp()
-        self.addCleanup(shutil.rmtree, self.target)
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        # Copy the sample documents once, tests only hard link to them
+        cls._samples_cache = tempfile.mkdtemp()
+        shutil.copytree(
+            os.path.join(os.path.dirname(__file__), "samples", "documents"),
+            os.path.join(cls._samples_cache, "documents"),
+        )
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls._samples_cache)
+        super().tearDownClass()
 
-        self.user = User.objects.create(username="temp_admin")
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create(username="temp_admin")
 
-        self.d1 = Document.objects.create(
+        cls.t1 = Tag.objects.create(name="t")
+        cls.dt1 = DocumentType.objects.create(name="dt")
+        cls.c1 = Correspondent.objects.create(name="c")
+        cls.sp1 = StoragePath.objects.create(path="{created_year}-{title}")
+
+        cls.d1 = Document.objects.create(
             content="Content",
             checksum="42995833e01aea9b3edee44bbfdd7ce1",
             archive_checksum="62acb0bcbfbcaa62ca6ad3668e4e404b",
@@ -40,60 +94,81 @@ class TestExportImport(DirectoriesMixin, TestCase):
             filename="0000001.pdf",
             mime_type="application/pdf",
             archive_filename="0000001.pdf",
+            correspondent=cls.c1,
+            document_type=cls.dt1,
         )
-        self.d2 = Document.objects.create(
+        cls.d2 = Document.objects.create(
             content="Content",
             checksum="9c9691e51741c1f4f41a20896af31770",
             title="wow2",
             filename="0000002.pdf",
             mime_type="application/pdf",
         )
-        self.d3 = Document.objects.create(
+        cls.d3 = Document.objects.create(
             content="Content",
             checksum="d38d7ed02e988e072caf924e0f3fcb76",
             title="wow2",
             filename="0000003.pdf",
             mime_type="application/pdf",
         )
-        self.d4 = Document.objects.create(
+        cls.d4 = Document.objects.create(
             content="Content",
             checksum="82186aaa94f0b98697d704b90fd1c072",
             title="wow_dec",
             filename="0000004.pdf.gpg",
             mime_type="application/pdf",
             storage_type=Document.STORAGE_TYPE_GPG,
+            storage_path=cls.sp1,
         )
+        cls.d1.tags.add(cls.t1)
 
-        self.comment = Comment.objects.create(
+        cls.comment = Comment.objects.create(
             comment="This is a comment. amaze.",
-            document=self.d1,
-            user=self.user,
+            document=cls.d1,
+            user=cls.user,
         )
 
-        self.t1 = Tag.objects.create(name="t")
-        self.dt1 = DocumentType.objects.create(name="dt")
-        self.c1 = Correspondent.objects.create(name="c")
-        self.sp1 = StoragePath.objects.create(path="{created_year}-{title}")
-
-        self.d1.tags.add(self.t1)
-        self.d1.correspondent = self.c1
-        self.d1.document_type = self.dt1
-        self.d1.save()
-        self.d4.storage_path = self.sp1
-        self.d4.save()
+    def setUp(self) -> None:
+        self.target = tempfile.mkdtemp(dir=EXPORT_TMPDIR)
+        self.addCleanup(shutil.rmtree, self.target)
+        self.manifest_path = Path(self.target) / "manifest.json"
         super().setUp()
 
-    def _get_document_from_manifest(self, manifest, id):
-        f = list(
-            filter(
-                lambda d: d["model"] == "documents.document" and d["pk"] == id,
-                manifest,
-            ),
+    @staticmethod
+    def _index_documents(manifest):
+        return {e["pk"]: e for e in manifest if e["model"] == _MODEL_DOCUMENT}
+
+    def _materialize_samples(self):
+        # Every test gets a new, empty media directory, nothing to remove
+        shutil.copytree(
+            os.path.join(self._samples_cache, "documents"),
+            os.path.join(self.dirs.media_dir, "documents"),
+            copy_function=_link_or_copy,
+            dirs_exist_ok=True,
         )
-        if len(f) == 1:
-            return f[0]
-        else:
-            raise ValueError(f"document with id {id} does not exist in manifest")
+
+    @staticmethod
+    def _touch(path):
+        # Sample files are hard links to the shared copy, don't modify that
+        shutil.copy2(path, path + ".copy")
+        os.replace(path + ".copy", path)
+        Path(path).touch()
+
+    def _exported_pdfs(self, documents):
+        for element in documents.values():
+            yield os.path.join(self.target, element[EXPORTER_FILE_NAME])
+            if EXPORTER_ARCHIVE_NAME in element:
+                yield os.path.join(self.target, element[EXPORTER_ARCHIVE_NAME])
+
+    def _assert_complete_pdf(self, path):
+        size = os.stat(path).st_size
+        self.assertGreater(size, 0)
+        with open(path, "rb") as f:
+            head = f.read(4096)
+            f.seek(-min(4096, size), os.SEEK_END)
+            tail = f.read()
+        self.assertTrue(head.startswith(b"%PDF-"))
+        self.assertIn(b"%%EOF", tail)
 
     @override_settings(PASSPHRASE="test")
     def _do_export(
@@ -104,6 +179,7 @@ class TestExportImport(DirectoriesMixin, TestCase):
         no_archive=False,
         no_thumbnail=False,
         split_manifest=False,
+        load_manifest=True,
     ):
         args = ["document_exporter", self.target]
         if use_filename_format:
@@ -121,88 +197,20 @@ class TestExportImport(DirectoriesMixin, TestCase):
 
         call_command(*args)
 
-        with open(os.path.join(self.target, "manifest.json")) as f:
-            manifest = json.load(f)
-
-        return manifest
-
-    def test_exporter(self, use_filename_format=False):
-        shutil.rmtree(os.path.join(self.dirs.media_dir, "documents"))
-        shutil.copytree(
-            os.path.join(os.path.dirname(__file__), "samples", "documents"),
-            os.path.join(self.dirs.media_dir, "documents"),
-        )
-
-        manifest = self._do_export(use_filename_format=use_filename_format)
-
-        self.assertEqual(len(manifest), 11)
-        self.assertEqual(
-            len(list(filter(lambda e: e["model"] == "documents.document", manifest))),
-            4,
-        )
-
-        self.assertTrue(os.path.exists(os.path.join(self.target, "manifest.json")))
-
-        self.assertEqual(
-            self._get_document_from_manifest(manifest, self.d1.id)["fields"]["title"],
-            "wow1",
-        )
-        self.assertEqual(
-            self._get_document_from_manifest(manifest, self.d2.id)["fields"]["title"],
-            "wow2",
-        )
-        self.assertEqual(
-            self._get_document_from_manifest(manifest, self.d3.id)["fields"]["title"],
-            "wow2",
-        )
-        self.assertEqual(
-            self._get_document_from_manifest(manifest, self.d4.id)["fields"]["title"],
-            "wow_dec",
-        )
-
-        for element in manifest:
-            if element["model"] == "documents.document":
-                fname = os.path.join(
-                    self.target,
-                    element[document_exporter.EXPORTER_FILE_NAME],
-                )
-                self.assertTrue(os.path.exists(fname))
-                self.assertTrue(
-                    os.path.exists(
-                        os.path.join(
-                            self.target,
-                            element[document_exporter.EXPORTER_THUMBNAIL_NAME],
-                        ),
-                    ),
-                )
-
-                with open(fname, "rb") as f:
-                    checksum = hashlib.md5(f.read()).hexdigest()
-                self.assertEqual(checksum, element["fields"]["checksum"])
-
-                self.assertEqual(
-                    element["fields"]["storage_type"],
-                    Document.STORAGE_TYPE_UNENCRYPTED,
-                )
+        if not load_manifest:
+            return None
 
-                if document_exporter.EXPORTER_ARCHIVE_NAME in element:
-                    fname = os.path.join(
-                        self.target,
-                        element[document_exporter.EXPORTER_ARCHIVE_NAME],
-                    )
-                    self.assertTrue(os.path.exists(fname))
-
-                    with open(fname, "rb") as f:
-                        checksum = hashlib.md5(f.read()).hexdigest()
-                    self.assertEqual(checksum, element["fields"]["archive_checksum"])
+        with open(self.manifest_path, "rb") as f:
+            manifest = load_json(f.read())
 
-            elif element["model"] == "documents.comment":
-                self.assertEqual(element["fields"]["comment"], self.comment.comment)
-                self.assertEqual(element["fields"]["document"], self.d1.id)
-                self.assertEqual(element["fields"]["user"], self.user.id)
+        return manifest
 
-        with paperless_environment() as dirs:
-            self.assertEqual(Document.objects.count(), 4)
+    def _assert_roundtrip_imports(self, sanity_check=True):
+        """
+        Imports the export into an empty database and checks the documents and
+        their relations came back
+        """
+        with paperless_environment():
             Document.objects.all().delete()
             Correspondent.objects.all().delete()
             DocumentType.objects.all().delete()
@@ -219,98 +227,177 @@ class TestExportImport(DirectoriesMixin, TestCase):
             self.assertEqual(Document.objects.get(id=self.d2.id).title, "wow2")
             self.assertEqual(Document.objects.get(id=self.d3.id).title, "wow2")
             self.assertEqual(Document.objects.get(id=self.d4.id).title, "wow_dec")
-            messages = check_sanity()
-            # everything is alright after the test
-            self.assertEqual(len(messages), 0)
+            if sanity_check:
+                messages = check_sanity()
+                # everything is alright after the test
+                self.assertEqual(len(messages), 0)
 
-    def test_exporter_with_filename_format(self):
-        shutil.rmtree(os.path.join(self.dirs.media_dir, "documents"))
-        shutil.copytree(
-            os.path.join(os.path.dirname(__file__), "samples", "documents"),
-            os.path.join(self.dirs.media_dir, "documents"),
+    @_with_sample_docs
+    def test_exporter(self, use_filename_format=False):
+        manifest = self._do_export(use_filename_format=use_filename_format)
+
+        documents = self._index_documents(manifest)
+
+        self.assertEqual(len(manifest), 11)
+        self.assertEqual(len(documents), 4)
+
+        self.assertTrue(self.manifest_path.is_file())
+
+        self.assertEqual(
+            {pk: element["fields"]["title"] for pk, element in documents.items()},
+            {
+                self.d1.id: "wow1",
+                self.d2.id: "wow2",
+                self.d3.id: "wow2",
+                self.d4.id: "wow_dec",
+            },
         )
 
+        for element in documents.values():
+            self.assertTrue(
+                os.path.exists(
+                    os.path.join(
+                        self.target,
+                        element[EXPORTER_THUMBNAIL_NAME],
+                    ),
+                ),
+            )
+            self.assertEqual(
+                element["fields"]["storage_type"],
+                Document.STORAGE_TYPE_UNENCRYPTED,
+            )
+
+        # The checksums are verified by the sanity check after the import,
+        # only make sure the files are complete here
+        for fname in self._exported_pdfs(documents):
+            self.assertTrue(os.path.exists(fname))
+            self._assert_complete_pdf(fname)
+
+        for element in manifest:
+            if element["model"] == _MODEL_COMMENT:
+                self.assertEqual(element["fields"]["comment"], self.comment.comment)
+                self.assertEqual(element["fields"]["document"], self.d1.id)
+                self.assertEqual(element["fields"]["user"], self.user.id)
+
+        self._assert_roundtrip_imports()
+
+    def test_exporter_with_filename_format(self):
         with override_settings(
             FILENAME_FORMAT="{created_year}/{correspondent}/{title}",
         ):
             self.test_exporter(use_filename_format=True)
 
+    @_with_sample_docs
     def test_update_export_changed_time(self):
-        shutil.rmtree(os.path.join(self.dirs.media_dir, "documents"))
-        shutil.copytree(
-            os.path.join(os.path.dirname(__file__), "samples", "documents"),
-            os.path.join(self.dirs.media_dir, "documents"),
-        )
-
-        self._do_export()
-        self.assertTrue(os.path.exists(os.path.join(self.target, "manifest.json")))
+        self._do_export(load_manifest=False)
+        self.assertTrue(self.manifest_path.is_file())
 
-        st_mtime_1 = os.stat(os.path.join(self.target, "manifest.json")).st_mtime
+        st_mtime_1 = self.manifest_path.stat().st_mtime
 
         with mock.patch(
-            "documents.management.commands.document_exporter.shutil.copy2",
+            "documents.management.commands.document_exporter.copy_file",
         ) as m:
-            self._do_export()
+            self._do_export(load_manifest=False)
             m.assert_not_called()
 
-        self.assertTrue(os.path.exists(os.path.join(self.target, "manifest.json")))
-        st_mtime_2 = os.stat(os.path.join(self.target, "manifest.json")).st_mtime
+            self.assertTrue(self.manifest_path.is_file())
+            st_mtime_2 = self.manifest_path.stat().st_mtime
 
-        Path(self.d1.source_path).touch()
+            m.reset_mock()
+            self._touch(self.d1.source_path)
 
-        with mock.patch(
-            "documents.management.commands.document_exporter.shutil.copy2",
-        ) as m:
-            self._do_export()
+            self._do_export(load_manifest=False)
             self.assertEqual(m.call_count, 1)
 
-        st_mtime_3 = os.stat(os.path.join(self.target, "manifest.json")).st_mtime
-        self.assertTrue(os.path.exists(os.path.join(self.target, "manifest.json")))
+        st_mtime_3 = self.manifest_path.stat().st_mtime
+        self.assertTrue(self.manifest_path.is_file())
 
         self.assertNotEqual(st_mtime_1, st_mtime_2)
         self.assertNotEqual(st_mtime_2, st_mtime_3)
 
+    @_with_sample_docs
     def test_update_export_changed_checksum(self):
-        shutil.rmtree(os.path.join(self.dirs.media_dir, "documents"))
-        shutil.copytree(
-            os.path.join(os.path.dirname(__file__), "samples", "documents"),
-            os.path.join(self.dirs.media_dir, "documents"),
-        )
+        self._do_export(load_manifest=False)
 
-        self._do_export()
-
-        self.assertTrue(os.path.exists(os.path.join(self.target, "manifest.json")))
+        self.assertTrue(self.manifest_path.is_file())
 
         with mock.patch(
-            "documents.management.commands.document_exporter.shutil.copy2",
+            "documents.management.commands.document_exporter.copy_file",
         ) as m:
-            self._do_export()
+            self._do_export(load_manifest=False)
             m.assert_not_called()
 
-        self.assertTrue(os.path.exists(os.path.join(self.target, "manifest.json")))
+            self.assertTrue(self.manifest_path.is_file())
+
+            m.reset_mock()
+            self.d2.checksum = "asdfasdgf3"
+            self.d2.save()
+
+            # Checksums are only compared for files whose size or time
+            # modified changed
+            self._touch(self.d2.source_path)
+
+            self._do_export(compare_checksums=True, load_manifest=False)
+            self.assertEqual(m.call_count, 1)
+
+        self.assertTrue(self.manifest_path.is_file())
 
-        self.d2.checksum = "asdfasdgf3"
-        self.d2.save()
+    @_with_sample_docs
+    def test_update_export_compare_checksums_unchanged(self):
+        self._do_export(load_manifest=False)
 
         with mock.patch(
-            "documents.management.commands.document_exporter.shutil.copy2",
+            "documents.management.commands.document_exporter.file_checksum",
         ) as m:
-            self._do_export(compare_checksums=True)
-            self.assertEqual(m.call_count, 1)
+            self._do_export(compare_checksums=True, load_manifest=False)
+            m.assert_not_called()
 
-        self.assertTrue(os.path.exists(os.path.join(self.target, "manifest.json")))
+        self._touch(self.d1.source_path)
 
-    def test_update_export_deleted_document(self):
-        shutil.rmtree(os.path.join(self.dirs.media_dir, "documents"))
-        shutil.copytree(
-            os.path.join(os.path.dirname(__file__), "samples", "documents"),
-            os.path.join(self.dirs.media_dir, "documents"),
+        with mock.patch(
+            "documents.management.commands.document_exporter.copy_file",
+        ) as m:
+            self._do_export(compare_checksums=True, load_manifest=False)
+            m.assert_not_called()
+
+    @_with_sample_docs
+    def test_update_export_checksum_cache(self):
+        self._do_export(load_manifest=False)
+        self._touch(self.d1.source_path)
+
+        self._do_export(compare_checksums=True, load_manifest=False)
+        self.assertTrue(
+            os.path.isfile(
+                os.path.join(self.target, document_exporter.CHECKSUM_CACHE_NAME),
+            ),
         )
 
+        with mock.patch(
+            "documents.management.commands.document_exporter.file_checksum",
+        ) as m:
+            self._do_export(compare_checksums=True, load_manifest=False)
+            m.assert_not_called()
+
+    @_with_sample_docs
+    def test_update_export_invalid_checksum_cache(self):
+        self._do_export(load_manifest=False)
+        self._touch(self.d1.source_path)
+
+        cache_path = os.path.join(self.target, document_exporter.CHECKSUM_CACHE_NAME)
+        for content in [b"{", b"[]", b'{"a": 1}', b'{"a": [1, 2]}']:
+            Path(cache_path).write_bytes(content)
+
+            # The cache is ignored and replaced
+            self._do_export(compare_checksums=True, load_manifest=False)
+            with open(cache_path, "rb") as f:
+                self.assertEqual(len(load_json(f.read())), 1)
+
+    @_with_sample_docs
+    def test_update_export_deleted_document(self):
         manifest = self._do_export()
 
         self.assertTrue(len(manifest), 7)
-        doc_from_manifest = self._get_document_from_manifest(manifest, self.d3.id)
+        doc_from_manifest = self._index_documents(manifest)[self.d3.id]
         self.assertTrue(
             os.path.isfile(
                 os.path.join(self.target, doc_from_manifest[EXPORTER_FILE_NAME]),
@@ -319,12 +406,7 @@ class TestExportImport(DirectoriesMixin, TestCase):
         self.d3.delete()
 
         manifest = self._do_export()
-        self.assertRaises(
-            ValueError,
-            self._get_document_from_manifest,
-            manifest,
-            self.d3.id,
-        )
+        self.assertNotIn(self.d3.id, self._index_documents(manifest))
         self.assertTrue(
             os.path.isfile(
                 os.path.join(self.target, doc_from_manifest[EXPORTER_FILE_NAME]),
@@ -341,25 +423,20 @@ class TestExportImport(DirectoriesMixin, TestCase):
         self.assertTrue(len(manifest), 6)
 
     @override_settings(FILENAME_FORMAT="{title}/{correspondent}")
+    @_with_sample_docs
     def test_update_export_changed_location(self):
-        shutil.rmtree(os.path.join(self.dirs.media_dir, "documents"))
-        shutil.copytree(
-            os.path.join(os.path.dirname(__file__), "samples", "documents"),
-            os.path.join(self.dirs.media_dir, "documents"),
-        )
-
-        m = self._do_export(use_filename_format=True)
+        self._do_export(use_filename_format=True, load_manifest=False)
         self.assertTrue(os.path.isfile(os.path.join(self.target, "wow1", "c.pdf")))
 
-        self.assertTrue(os.path.exists(os.path.join(self.target, "manifest.json")))
+        self.assertTrue(self.manifest_path.is_file())
 
         self.d1.title = "new_title"
         self.d1.save()
-        self._do_export(use_filename_format=True, delete=True)
+        self._do_export(use_filename_format=True, delete=True, load_manifest=False)
         self.assertFalse(os.path.isfile(os.path.join(self.target, "wow1", "c.pdf")))
         self.assertFalse(os.path.isdir(os.path.join(self.target, "wow1")))
         self.assertTrue(os.path.isfile(os.path.join(self.target, "new_title", "c.pdf")))
-        self.assertTrue(os.path.exists(os.path.join(self.target, "manifest.json")))
+        self.assertTrue(self.manifest_path.is_file())
         self.assertTrue(os.path.isfile(os.path.join(self.target, "wow2", "none.pdf")))
         self.assertTrue(
             os.path.isfile(os.path.join(self.target, "wow2", "none_01.pdf")),
@@ -367,7 +444,7 @@ class TestExportImport(DirectoriesMixin, TestCase):
 
     def test_export_missing_files(self):
 
-        target = tempfile.mkdtemp()
+        target = tempfile.mkdtemp(dir=EXPORT_TMPDIR)
         self.addCleanup(shutil.rmtree, target)
         Document.objects.create(
             checksum="AAAAAAAAAAAAAAAAA",
@@ -377,7 +454,33 @@ class TestExportImport(DirectoriesMixin, TestCase):
         )
         self.assertRaises(FileNotFoundError, call_command, "document_exporter", target)
 
+    @_with_sample_docs
+    def test_import_existing_file(self):
+        self._do_export(load_manifest=False)
+
+        with paperless_environment():
+            Document.objects.all().delete()
+            Path(settings.ORIGINALS_DIR, self.d1.filename).touch()
+
+            self.assertRaises(
+                FileExistsError,
+                call_command,
+                "document_importer",
+                self.target,
+            )
+
+    @override_settings(PASSPHRASE="wrong")
+    @_with_sample_docs
+    def test_export_wrong_passphrase(self):
+        self.assertRaises(
+            DecryptionError,
+            call_command,
+            "document_exporter",
+            self.target,
+        )
+
     @override_settings(PASSPHRASE="test")
+    @_with_sample_docs
     def test_export_zipped(self):
         """
         GIVEN:
@@ -388,12 +491,6 @@ class TestExportImport(DirectoriesMixin, TestCase):
             - Zipfile is created
             - Zipfile contains exported files
         """
-        shutil.rmtree(os.path.join(self.dirs.media_dir, "documents"))
-        shutil.copytree(
-            os.path.join(os.path.dirname(__file__), "samples", "documents"),
-            os.path.join(self.dirs.media_dir, "documents"),
-        )
-
         args = ["document_exporter", self.target, "--zip"]
 
         call_command(*args)
@@ -406,11 +503,41 @@ class TestExportImport(DirectoriesMixin, TestCase):
         self.assertTrue(os.path.isfile(expected_file))
 
         with ZipFile(expected_file) as zip:
-            self.assertEqual(len(zip.namelist()), 11)
-            self.assertIn("manifest.json", zip.namelist())
-            self.assertIn("version.json", zip.namelist())
+            names = set(zip.namelist())
+            self.assertEqual(len(names), 11)
+            self.assertIn("manifest.json", names)
+            self.assertIn("version.json", names)
+
+    @override_settings(PASSPHRASE="test")
+    @_with_sample_docs
+    def test_export_zipped_no_checksum_cache(self):
+        """
+        GIVEN:
+            - Request to export documents to zipfile, comparing checksums
+        WHEN:
+            - Documents are exported
+        THEN:
+            - Zipfile does not contain the checksum cache
+        """
+        call_command(
+            "document_exporter",
+            self.target,
+            "--zip",
+            "--compare-checksums",
+        )
+
+        expected_file = os.path.join(
+            self.target,
+            f"export-{timezone.localdate().isoformat()}.zip",
+        )
+
+        with ZipFile(expected_file) as zip:
+            names = set(zip.namelist())
+            self.assertEqual(len(names), 11)
+            self.assertNotIn(document_exporter.CHECKSUM_CACHE_NAME, names)
 
     @override_settings(PASSPHRASE="test")
+    @_with_sample_docs
     def test_export_zipped_format(self):
         """
         GIVEN:
@@ -422,12 +549,6 @@ class TestExportImport(DirectoriesMixin, TestCase):
             - Zipfile is created
             - Zipfile contains exported files
         """
-        shutil.rmtree(os.path.join(self.dirs.media_dir, "documents"))
-        shutil.copytree(
-            os.path.join(os.path.dirname(__file__), "samples", "documents"),
-            os.path.join(self.dirs.media_dir, "documents"),
-        )
-
         args = ["document_exporter", self.target, "--zip", "--use-filename-format"]
 
         with override_settings(
@@ -444,83 +565,40 @@ class TestExportImport(DirectoriesMixin, TestCase):
 
         with ZipFile(expected_file) as zip:
             # Extras are from the directories, which also appear in the listing
-            self.assertEqual(len(zip.namelist()), 14)
-            self.assertIn("manifest.json", zip.namelist())
-            self.assertIn("version.json", zip.namelist())
+            names = set(zip.namelist())
+            self.assertEqual(len(names), 14)
+            self.assertIn("manifest.json", names)
+            self.assertIn("version.json", names)
 
+    @_with_sample_docs
     def test_no_archive(self):
-        shutil.rmtree(os.path.join(self.dirs.media_dir, "documents"))
-        shutil.copytree(
-            os.path.join(os.path.dirname(__file__), "samples", "documents"),
-            os.path.join(self.dirs.media_dir, "documents"),
-        )
+        documents = self._index_documents(self._do_export())
+        self.assertTrue(any(EXPORTER_ARCHIVE_NAME in e for e in documents.values()))
 
-        manifest = self._do_export()
-        has_archive = False
-        for element in manifest:
-            if element["model"] == "documents.document":
-                has_archive = (
-                    has_archive or document_exporter.EXPORTER_ARCHIVE_NAME in element
-                )
-        self.assertTrue(has_archive)
-
-        has_archive = False
-        manifest = self._do_export(no_archive=True)
-        for element in manifest:
-            if element["model"] == "documents.document":
-                has_archive = (
-                    has_archive or document_exporter.EXPORTER_ARCHIVE_NAME in element
-                )
-        self.assertFalse(has_archive)
-
-        with paperless_environment() as dirs:
-            call_command("document_importer", self.target)
-            self.assertEqual(Document.objects.count(), 4)
+        documents = self._index_documents(self._do_export(no_archive=True))
+        self.assertFalse(any(EXPORTER_ARCHIVE_NAME in e for e in documents.values()))
 
+    @_with_sample_docs
     def test_no_thumbnail(self):
-        shutil.rmtree(os.path.join(self.dirs.media_dir, "documents"))
-        shutil.copytree(
-            os.path.join(os.path.dirname(__file__), "samples", "documents"),
-            os.path.join(self.dirs.media_dir, "documents"),
-        )
+        documents = self._index_documents(self._do_export())
+        self.assertTrue(any(EXPORTER_THUMBNAIL_NAME in e for e in documents.values()))
 
-        manifest = self._do_export()
-        has_thumbnail = False
-        for element in manifest:
-            if element["model"] == "documents.document":
-                has_thumbnail = (
-                    has_thumbnail
-                    or document_exporter.EXPORTER_THUMBNAIL_NAME in element
-                )
-        self.assertTrue(has_thumbnail)
-
-        has_thumbnail = False
-        manifest = self._do_export(no_thumbnail=True)
-        for element in manifest:
-            if element["model"] == "documents.document":
-                has_thumbnail = (
-                    has_thumbnail
-                    or document_exporter.EXPORTER_THUMBNAIL_NAME in element
-                )
-        self.assertFalse(has_thumbnail)
-
-        with paperless_environment() as dirs:
-            call_command("document_importer", self.target)
-            self.assertEqual(Document.objects.count(), 4)
+        documents = self._index_documents(self._do_export(no_thumbnail=True))
+        self.assertFalse(any(EXPORTER_THUMBNAIL_NAME in e for e in documents.values()))
 
+    @_with_sample_docs
     def test_split_manifest(self):
-        shutil.rmtree(os.path.join(self.dirs.media_dir, "documents"))
-        shutil.copytree(
-            os.path.join(os.path.dirname(__file__), "samples", "documents"),
-            os.path.join(self.dirs.media_dir, "documents"),
-        )
-
         manifest = self._do_export(split_manifest=True)
-        has_document = False
-        for element in manifest:
-            has_document = has_document or element["model"] == "documents.document"
-        self.assertFalse(has_document)
+        self.assertEqual(self._index_documents(manifest), {})
+
+    @_with_sample_docs
+    def test_export_options_roundtrip(self):
+        manifest = self._do_export(
+            no_archive=True,
+            no_thumbnail=True,
+            split_manifest=True,
+        )
+        self.assertEqual(self._index_documents(manifest), {})
 
-        with paperless_environment() as dirs:
-            call_command("document_importer", self.target)
-            self.assertEqual(Document.objects.count(), 4)
+        # Documents refer to archive versions that were not exported
+        self._assert_roundtrip_imports(sanity_check=False)
@@ -0,0 +1,80 @@
+import datetime
+import decimal
+import json
+from unittest import mock
+from unittest import skipIf
+
+from django.test import TestCase
+from documents.management import manifest
+
+
+class TestManifestJson(TestCase):
+
+    data = [
+        {
+            "model": "documents.document",
+            "pk": 1,
+            "fields": {
+                "title": "Überweisung für Café – 日本語",
+                "created": datetime.datetime(
+                    2022,
+                    3,
+                    4,
+                    12,
+                    30,
+                    15,
+                    123456,
+                    tzinfo=datetime.timezone(datetime.timedelta(hours=2)),
+                ),
+                "added": datetime.datetime(
+                    2022,
+                    3,
+                    4,
+                    10,
+                    30,
+                    15,
+                    654321,
+                    tzinfo=datetime.timezone.utc,
+                ),
+                "date": datetime.date(2022, 3, 4),
+                "amount": decimal.Decimal("12.50"),
+                "tags": [],
+                "archive_filename": None,
+            },
+        },
+    ]
+
+    expected = [
+        {
+            "model": "documents.document",
+            "pk": 1,
+            "fields": {
+                "title": "Überweisung für Café – 日本語",
+                "created": "2022-03-04T12:30:15.123+02:00",
+                "added": "2022-03-04T10:30:15.654Z",
+                "date": "2022-03-04",
+                "amount": "12.50",
+                "tags": [],
+                "archive_filename": None,
+            },
+        },
+    ]
+
+    def test_json_fallback(self):
+        with mock.patch.object(manifest, "orjson", None):
+            data = manifest.dump_json(self.data)
+
+            self.assertIsInstance(data, bytes)
+            self.assertEqual(json.loads(data), self.expected)
+            self.assertEqual(manifest.load_json(data), self.expected)
+
+    @skipIf(manifest.orjson is None, "orjson is not installed")
+    def test_orjson_matches_fallback(self):
+        data = manifest.dump_json(self.data)
+        with mock.patch.object(manifest, "orjson", None):
+            fallback_data = manifest.dump_json(self.data)
+
+        self.assertIsInstance(data, bytes)
+        self.assertEqual(json.loads(data), json.loads(fallback_data))
+        self.assertEqual(json.loads(data), self.expected)
+        self.assertEqual(manifest.load_json(fallback_data), self.expected)
@@ -2,6 +2,10 @@ import gnupg
 from django.conf import settings
 
 
+class DecryptionError(Exception):
+    pass
+
+
 class GnuPG:
     """
     A handy singleton to use when handling encrypted files.
@@ -16,3 +20,23 @@ class GnuPG:
             passphrase = settings.PASSPHRASE
 
         return cls.gpg.decrypt_file(file_handle, passphrase=passphrase).data
+
+    @classmethod
+    def decrypt_to_file(cls, file_handle, output, passphrase=None):
+        """
+        Like decrypted, but has gpg write the plaintext to the file at output
+        instead of returning it in memory. Raises DecryptionError if gpg
+        fails, e.g. because of a wrong passphrase.
+        """
+
+        if not passphrase:
+            passphrase = settings.PASSPHRASE
+
+        result = cls.gpg.decrypt_file(
+            file_handle,
+            passphrase=passphrase,
+            output=output,
+        )
+        if not result.ok:
+            raise DecryptionError(f"Could not decrypt to {output}: {result.status}")
+        return result